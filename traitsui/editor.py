@@ -313,7 +313,7 @@ class Editor(HasPrivateTraits):
         new_value : any
             The new value of the trait.
         """
-        return UndoItem(
+        return UndoItem.acquire(
             object=object, name=name, old_value=old_value, new_value=new_value
         )
 
@@ -15,9 +15,20 @@ import functools
 import unittest
 
 from pyface.toolkit import toolkit_object
+from traits.api import HasTraits, Int, List, Str
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from traitsui.tests.test_editor import create_editor
-from traitsui.undo import UndoHistory
+from traitsui.undo import (
+    ListUndoItem,
+    UndoHistory,
+    UndoHistoryUndoItem,
+    UndoItem,
+)
 
 GuiTestAssistant = toolkit_object("util.gui_test_assistant:GuiTestAssistant")
 no_gui_test_assistant = GuiTestAssistant.__name__ == "Unimplemented"
@@ -27,6 +38,582 @@ if no_gui_test_assistant:
         pass
 
 
+class SimpleExample(HasTraits):
+    """ A simple HasTraits class to perform undoable changes on. """
+
+    value = Int()
+
+    str_value = Str()
+
+    list_value = List()
+
+
+class TestUndoItem(unittest.TestCase):
+
+    def test_undo_redo(self):
+        example = SimpleExample(value=11)
+        undo_item = UndoItem(
+            object=example, name="value", old_value=10, new_value=11
+        )
+
+        undo_item.undo()
+        self.assertEqual(example.value, 10)
+
+        undo_item.redo()
+        self.assertEqual(example.value, 11)
+
+    def test_list_value_snapshot(self):
+        example = SimpleExample()
+        old_list = [1, 2, 3]
+        undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=old_list,
+            new_value=[1, 2, 3, 4],
+        )
+
+        # The stored value is a snapshot, not the caller's list:
+        self.assertEqual(undo_item.old_value, [1, 2, 3])
+        self.assertIsNot(undo_item.old_value, old_list)
+
+    def test_merge_numeric(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example, name="value", old_value=10, new_value=11
+        )
+        next_undo_item = UndoItem(
+            object=example, name="value", old_value=11, new_value=12
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertEqual(undo_item.new_value, 12)
+
+    def test_merge_list_single_change(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=[1, 2, 3],
+            new_value=[1, 5, 3],
+        )
+        next_undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=[1, 5, 3],
+            new_value=[1, 7, 3],
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertEqual(undo_item.new_value, [1, 7, 3])
+
+    def test_merge_list_multiple_changes(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=[1, 2, 3],
+            new_value=[1, 5, 3],
+        )
+        next_undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=[1, 5, 3],
+            new_value=[4, 5, 6],
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+    def test_merge_str_insertion(self):
+        example = SimpleExample(str_value="foo")
+        undo_item = UndoItem(
+            object=example, name="str_value", old_value="fo", new_value="foo"
+        )
+        next_undo_item = UndoItem(
+            object=example, name="str_value", old_value="foo",
+            new_value="fooo",
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertEqual(undo_item.new_value, "fooo")
+
+    def test_merge_str_deletion(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example, name="str_value", old_value="fo", new_value="foo"
+        )
+        next_undo_item = UndoItem(
+            object=example, name="str_value", old_value="foo", new_value="fo"
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertEqual(undo_item.new_value, "fo")
+
+    def test_merge_str_replacement(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example, name="str_value", old_value="fo", new_value="foo"
+        )
+        next_undo_item = UndoItem(
+            object=example, name="str_value", old_value="foo", new_value="fro"
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertEqual(undo_item.new_value, "fro")
+
+    def test_merge_str_multiple_changes(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example, name="str_value", old_value="fo", new_value="foo"
+        )
+        next_undo_item = UndoItem(
+            object=example, name="str_value", old_value="foo", new_value="bar"
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+    def test_merge_str_length_mismatch(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example, name="str_value", old_value="fo", new_value="foo"
+        )
+        next_undo_item = UndoItem(
+            object=example, name="str_value", old_value="foo",
+            new_value="foooo",
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+    def test_merge_long_numeric_list(self):
+        example = SimpleExample()
+        old_list = list(range(1000))
+        new_list = list(range(1000))
+        new_list[500] = -1
+        undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=old_list,
+            new_value=new_list,
+        )
+        newer_list = list(range(1000))
+        newer_list[500] = -2
+        next_undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=new_list,
+            new_value=newer_list,
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertEqual(undo_item.new_value, newer_list)
+
+    def test_merge_long_numeric_list_multiple_changes(self):
+        example = SimpleExample()
+        old_list = list(range(1000))
+        new_list = list(range(1000))
+        new_list[500] = -1
+        new_list[501] = -1
+        undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=old_list,
+            new_value=old_list,
+        )
+        next_undo_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=old_list,
+            new_value=new_list,
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_merge_array_single_change(self):
+        example = SimpleExample()
+        old_array = np.arange(100)
+        new_array = np.arange(100)
+        new_array[50] = -1
+        undo_item = UndoItem(
+            object=example,
+            name="value",
+            old_value=old_array,
+            new_value=old_array,
+        )
+        next_undo_item = UndoItem(
+            object=example,
+            name="value",
+            old_value=old_array,
+            new_value=new_array,
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+        self.assertIs(undo_item.new_value, new_array)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_merge_array_multiple_changes(self):
+        example = SimpleExample()
+        old_array = np.arange(100)
+        new_array = np.arange(100)
+        new_array[50] = -1
+        new_array[51] = -1
+        undo_item = UndoItem(
+            object=example,
+            name="value",
+            old_value=old_array,
+            new_value=old_array,
+        )
+        next_undo_item = UndoItem(
+            object=example,
+            name="value",
+            old_value=old_array,
+            new_value=new_array,
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+    def test_merge_different_traits(self):
+        example = SimpleExample()
+        undo_item = UndoItem(
+            object=example, name="value", old_value=10, new_value=11
+        )
+        next_undo_item = UndoItem(
+            object=example, name="str_value", old_value="", new_value="foo"
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+
+class TestListUndoItem(unittest.TestCase):
+
+    def test_undo_redo(self):
+        example = SimpleExample(list_value=[1, 5, 6, 7, 4])
+        undo_item = ListUndoItem(
+            object=example,
+            name="list_value",
+            index=1,
+            added=[5, 6, 7],
+            removed=[2, 3],
+        )
+
+        undo_item.undo()
+        self.assertEqual(example.list_value, [1, 2, 3, 4])
+
+        undo_item.redo()
+        self.assertEqual(example.list_value, [1, 5, 6, 7, 4])
+
+    def test_undo_after_list_replacement(self):
+        # Undoing or redoing other items in a history can replace the list
+        # object held by the trait (assigning a list via setattr installs a
+        # new TraitListObject), so the item must not splice a stale
+        # reference fetched on an earlier undo/redo cycle:
+        example = SimpleExample(list_value=[1, 9, 3])
+        edit_item = ListUndoItem(
+            object=example, name="list_value", index=1, added=[9], removed=[2]
+        )
+        example.list_value = [7, 8]
+        replace_item = UndoItem(
+            object=example,
+            name="list_value",
+            old_value=[1, 9, 3],
+            new_value=[7, 8],
+        )
+
+        for _ in range(2):
+            replace_item.undo()
+            edit_item.undo()
+            self.assertEqual(example.list_value, [1, 2, 3])
+            edit_item.redo()
+            replace_item.redo()
+            self.assertEqual(example.list_value, [7, 8])
+
+    def test_merge_identical(self):
+        example = SimpleExample()
+        added = [object(), object()]
+        removed = [object()]
+        undo_item = ListUndoItem(
+            object=example,
+            name="list_value",
+            index=1,
+            added=added,
+            removed=removed,
+        )
+        next_undo_item = ListUndoItem(
+            object=example,
+            name="list_value",
+            index=1,
+            added=added,
+            removed=removed,
+        )
+
+        self.assertTrue(undo_item.merge_undo(next_undo_item))
+
+    def test_merge_different_items(self):
+        example = SimpleExample()
+        undo_item = ListUndoItem(
+            object=example,
+            name="list_value",
+            index=1,
+            added=[5, 6],
+            removed=[2],
+        )
+        next_undo_item = ListUndoItem(
+            object=example,
+            name="list_value",
+            index=1,
+            added=[{}, {}],
+            removed=[2],
+        )
+
+        self.assertFalse(undo_item.merge_undo(next_undo_item))
+
+
+class TestUndoItemPool(unittest.TestCase):
+
+    def setUp(self):
+        UndoItem._free.clear()
+
+    def test_acquire_release_round_trip(self):
+        example = SimpleExample()
+        undo_item = UndoItem.acquire(
+            object=example, name="value", old_value=1, new_value=2
+        )
+        undo_item.release()
+
+        reused = UndoItem.acquire(
+            object=example, name="value", old_value=3, new_value=4
+        )
+        self.assertIs(reused, undo_item)
+        self.assertEqual(reused.old_value, 3)
+        self.assertEqual(reused.new_value, 4)
+
+    def test_merged_item_is_recycled(self):
+        example = SimpleExample(str_value="two")
+        history = UndoHistory()
+        history.add(
+            UndoItem(
+                object=example,
+                name="str_value",
+                old_value="one",
+                new_value="two",
+            )
+        )
+        merged = UndoItem(
+            object=example, name="str_value", old_value="two",
+            new_value="twoo",
+        )
+        history.add(merged)
+
+        self.assertEqual(len(history.history), 1)
+        self.assertIn(merged, UndoItem._free)
+
+
+class TestUndoHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.example = SimpleExample(str_value="one")
+        self.history = UndoHistory()
+
+    def _change(self, new_value):
+        """ Performs an undoable change on the example object. """
+        undo_item = UndoItem(
+            object=self.example,
+            name="str_value",
+            old_value=self.example.str_value,
+            new_value=new_value,
+        )
+        self.example.str_value = new_value
+        return undo_item
+
+    def test_add_undo_redo(self):
+        self.history.add(self._change("two"))
+        self.history.add(self._change("three"))
+
+        self.assertEqual(self.history.now, 2)
+        self.assertEqual(len(self.history.history), 2)
+        self.assertTrue(self.history.can_undo)
+        self.assertFalse(self.history.can_redo)
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "two")
+        self.assertEqual(self.history.now, 1)
+        self.assertTrue(self.history.can_redo)
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "one")
+        self.assertFalse(self.history.can_undo)
+
+        self.history.redo()
+        self.assertEqual(self.example.str_value, "two")
+
+        self.history.redo()
+        self.assertEqual(self.example.str_value, "three")
+        self.assertFalse(self.history.can_redo)
+
+    def test_add_merges_single_item_groups(self):
+        self.history.add(self._change("two"))
+        # A single-character insertion is merged into the previous item:
+        self.history.add(self._change("twoo"))
+
+        self.assertEqual(self.history.now, 1)
+        self.assertEqual(len(self.history.history), 1)
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "one")
+
+    def test_add_after_undo_discards_redo(self):
+        self.history.add(self._change("two"))
+        self.history.add(self._change("three"))
+        self.history.undo()
+        self.history.add(self._change("four"))
+
+        self.assertEqual(self.history.now, 2)
+        self.assertEqual(len(self.history.history), 2)
+        self.assertFalse(self.history.can_redo)
+
+    def test_extend_appends_to_group(self):
+        self.history.add(self._change("two"))
+        self.history.add(self._change("three"), extend=True)
+
+        self.assertEqual(self.history.now, 1)
+        self.assertEqual(len(self.history.history), 1)
+        self.assertEqual(len(self.history.history[0]), 2)
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "one")
+
+    def test_batch_coalesces_updates(self):
+        undoable_events = []
+        self.history.on_trait_change(
+            lambda value: undoable_events.append(value), "undoable"
+        )
+        now_changes = []
+        self.history.on_trait_change(
+            lambda value: now_changes.append(value), "now"
+        )
+
+        with self.history.batch():
+            self.history.add(self._change("two"))
+            self.history.add(self._change("three"))
+
+        self.assertEqual(self.history.now, 2)
+        self.assertEqual(len(self.history.history), 2)
+        # The two adds produce a single 'now' change and one notification:
+        self.assertEqual(now_changes, [2])
+        self.assertEqual(undoable_events, [True])
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "two")
+
+    def test_batch_merges_items(self):
+        with self.history.batch():
+            self.history.add(self._change("two"))
+            self.history.add(self._change("twoo"))
+
+        self.assertEqual(self.history.now, 1)
+        self.assertEqual(len(self.history.history), 1)
+
+    def test_batch_undo_redo_use_pending_state(self):
+        # undo/redo inside a batch must see the deferred 'now' from the
+        # preceding adds, not the stale trait value:
+        with self.history.batch():
+            self.history.add(self._change("two"))
+            self.history.add(self._change("three"))
+            self.history.undo()
+            self.history.redo()
+            self.history.undo()
+
+        self.assertEqual(self.history.now, 1)
+        self.assertEqual(self.example.str_value, "two")
+        self.assertTrue(self.history.can_undo)
+        self.assertTrue(self.history.can_redo)
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "one")
+        self.assertFalse(self.history.can_undo)
+
+    def test_batch_clear_discards_pending_state(self):
+        # clear() inside a batch must also discard the deferred 'now', or
+        # batch exit would restore a position beyond the emptied history:
+        self.history.add(self._change("two"))
+        with self.history.batch():
+            self.history.add(self._change("three"))
+            self.history.clear()
+            self.history.add(self._change("four"))
+
+        self.assertEqual(self.history.now, 1)
+        self.assertEqual(len(self.history.history), 1)
+        self.assertTrue(self.history.can_undo)
+
+        self.history.undo()
+        self.assertEqual(self.example.str_value, "three")
+        self.assertFalse(self.history.can_undo)
+
+    def test_max_depth_bounds_history(self):
+        self.history.max_depth = 3
+        for new_value in ["two", "three", "four", "five", "six"]:
+            self.history.add(self._change(new_value))
+
+        self.assertEqual(len(self.history.history), 3)
+        self.assertEqual(self.history.now, 3)
+
+        # Undoing everything stops at the oldest retained change:
+        self.history.undo()
+        self.history.undo()
+        self.history.undo()
+        self.assertFalse(self.history.can_undo)
+        self.assertEqual(self.example.str_value, "three")
+
+    def test_max_depth_unbounded(self):
+        self.history.max_depth = 0
+        for new_value in ["two", "three", "four", "five", "six"]:
+            self.history.add(self._change(new_value))
+
+        self.assertEqual(len(self.history.history), 5)
+
+    def test_revert(self):
+        self.history.add(self._change("two"))
+        self.history.add(self._change("three"))
+        self.history.revert()
+
+        self.assertEqual(self.example.str_value, "one")
+        self.assertEqual(self.history.now, 0)
+        self.assertEqual(len(self.history.history), 0)
+        self.assertFalse(self.history.can_undo)
+        self.assertFalse(self.history.can_redo)
+
+    def test_clear(self):
+        self.history.add(self._change("two"))
+        self.history.clear()
+
+        self.assertEqual(self.history.now, 0)
+        self.assertEqual(len(self.history.history), 0)
+        self.assertEqual(self.example.str_value, "two")
+
+
+class TestUndoHistoryUndoItem(unittest.TestCase):
+
+    def test_undo_redo(self):
+        example = SimpleExample(str_value="one")
+        nested_history = UndoHistory()
+        for new_value in ["two", "three"]:
+            nested_history.add(
+                UndoItem(
+                    object=example,
+                    name="str_value",
+                    old_value=example.str_value,
+                    new_value=new_value,
+                )
+            )
+            example.str_value = new_value
+        undo_item = UndoHistoryUndoItem(history=nested_history)
+
+        undo_item.undo()
+        self.assertEqual(example.str_value, "one")
+
+        undo_item.redo()
+        self.assertEqual(example.str_value, "three")
+
+
 @unittest.skipIf(no_gui_test_assistant, "No GuiTestAssistant")
 class TestEditorUndo(GuiTestAssistant, unittest.TestCase):
 
@@ -58,10 +645,12 @@ class TestEditorUndo(GuiTestAssistant, unittest.TestCase):
 
         self.assertEqual(editor.old_value, "test")
 
-        # Enter "ab"
+        # Enter "one" and "two".  The values in this test are chosen so that
+        # no two consecutive values differ by a single character, since such
+        # changes would be merged into a single history entry.
         with editor.updating_value():
-            self.gui.set_trait_later(editor.control, "control_value", "a")
-            self.gui.set_trait_later(editor.control, "control_value", "ab")
+            self.gui.set_trait_later(editor.control, "control_value", "one")
+            self.gui.set_trait_later(editor.control, "control_value", "two")
 
         # Perform an UNDO
         self.undo(editor)
@@ -83,9 +672,9 @@ class TestEditorUndo(GuiTestAssistant, unittest.TestCase):
                                                     expected_history_length=2),
                                   timeout=5.0)
 
-        # Enter a new character 'c' at the end
+        # Enter a new value "three"
         with editor.updating_value():
-            self.gui.set_trait_later(editor.control, "control_value", "abc")
+            self.gui.set_trait_later(editor.control, "control_value", "three")
 
         # Perform an UNDO
         self.undo(editor)
@@ -97,9 +686,9 @@ class TestEditorUndo(GuiTestAssistant, unittest.TestCase):
                                                     expected_history_length=3),
                                   timeout=5.0)
 
-        # Enter a new character 'd' at the end
+        # Enter a new value "four"
         with editor.updating_value():
-            self.gui.set_trait_later(editor.control, "control_value", "abd")
+            self.gui.set_trait_later(editor.control, "control_value", "four")
         self.event_loop_helper.event_loop_with_timeout()
 
         # Expect 3 items in history and pointer at second item
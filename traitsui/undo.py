@@ -22,10 +22,14 @@
 
 
 import collections
+import reprlib
+from contextlib import contextmanager
 
 
 
 from traits.api import (
+    Any,
+    Bool,
     Event,
     HasPrivateTraits,
     HasStrictTraits,
@@ -39,14 +43,142 @@ from traits.api import (
 )
 
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _count_diffs(a, b):
+        """ Counts the differing elements of two 1D arrays, stopping as
+        soon as a second difference is found.
+        """
+        count = 0
+        for i in range(a.shape[0]):
+            if a[i] != b[i]:
+                count += 1
+                if count >= 2:
+                    return count
+        return count
+
+else:
+
+    def _count_diffs(a, b):
+        """ Counts the differing elements of two 1D arrays. """
+        return int(np.count_nonzero(a != b))
+
+
 NumericTypes = (int, float, complex)
-SimpleTypes = (str, bytes) + NumericTypes
+# A frozenset makes the per-element membership tests in merge_undo O(1):
+SimpleTypes = frozenset((str, bytes) + NumericTypes)
+
+#: Bounded repr used when formatting undo items, so that printing or
+#: logging an item costs O(1) regardless of the size of its values:
+_item_repr = reprlib.Repr()
+_item_repr.maxlist = 6
+_item_repr.maxstring = 40
+_item_repr.maxother = 40
+
+#: Minimum sequence length before converting to NumPy arrays pays off:
+_VECTORIZE_THRESHOLD = 32
+
+
+def _common_prefix_len(a, b):
+    """ Returns the length of the longest common prefix of two strings.
+
+    Uses slice comparisons, which run at C speed, with a doubling probe
+    followed by a binary search of the boundary, so only O(log n)
+    comparisons are made instead of a Python-level character loop.
+    """
+    n = min(len(a), len(b))
+    lo = 0
+    k = 1
+    while (k <= n) and (a[:k] == b[:k]):
+        lo = k
+        k += k
+    hi = min(k, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _vectorized_diff_count(v1, v2):
+    """ Counts the differing elements of two numeric sequences using NumPy.
+
+    Returns None if NumPy is not available or the sequences are not
+    homogeneous numeric sequences of the same dtype, in which case the
+    caller should fall back to the element-wise Python loop.
+    """
+    if (np is None) or (len(v1) < _VECTORIZE_THRESHOLD):
+        return None
+    if type(v1[0]) not in NumericTypes:
+        return None
+    try:
+        a = np.asarray(v1)
+        b = np.asarray(v2)
+    except Exception:
+        return None
+    if (
+        (a.dtype != b.dtype)
+        or (a.dtype.kind not in "iufc")
+        or (a.shape != b.shape)
+    ):
+        return None
+    return int(np.count_nonzero(a != b))
 
 
 class AbstractUndoItem(HasPrivateTraits):
     """ Abstract base class for undo items.
     """
 
+    #: Free list of released instances available for reuse.  Subclasses that
+    #: want pooling define a class-level deque of their own, so instances of
+    #: different classes are never mixed.
+    _free = None
+
+    @classmethod
+    def acquire(cls, **traits):
+        """ Returns an instance of the class with the given trait values.
+
+        If a previously released instance is available on the class's free
+        list, it is refilled and returned, skipping the HasTraits instance
+        setup machinery; otherwise a new instance is created.
+        """
+        free = cls._free
+        if free:
+            item = free.pop()
+            item.trait_set(**traits)
+            return item
+        return cls(**traits)
+
+    def release(self):
+        """ Returns the item to its class's free list for later reuse.
+
+        Must only be called when the history no longer references the item;
+        any state the item holds is cleared.
+        """
+        free = type(self)._free
+        if free is not None:
+            self._reset()
+            free.append(self)
+
+    def _reset(self):
+        """ Clears references held by the item prior to reuse.
+        """
+        pass
+
     def undo(self):
         """ Undoes the change.
         """
@@ -62,6 +194,12 @@ class AbstractUndoItem(HasPrivateTraits):
         """
         return False
 
+    # Direct reference to the class's merge_undo implementation, so callers
+    # on the add() hot path can invoke it as a plain function instead of
+    # looking the method up on the instance.  Subclasses overriding
+    # merge_undo rebind this at the end of their class body.
+    _merge_fn = merge_undo
+
 
 class UndoItem(AbstractUndoItem):
     """ A change to an object trait, which can be undone.
@@ -71,34 +209,86 @@ class UndoItem(AbstractUndoItem):
     #  Trait definitions:
     # -------------------------------------------------------------------------
 
+    #: Free list of released instances (see AbstractUndoItem.acquire)
+    _free = collections.deque(maxlen=256)
+
     #: Object the change occurred on
     object = Instance(HasTraits)
 
     #: Name of the trait that changed
     name = Str()
 
-    #: Old value of the changed trait
-    old_value = Property()
-
-    #: New value of the changed trait
-    new_value = Property()
-
-    def _get_old_value(self):
+    # Note: 'old_value' and 'new_value' are plain Python properties rather
+    # than Property traits.  They are read and written on every merge
+    # attempt, and the traits Property dispatch is measurable overhead for
+    # what is morally an attribute access.
+
+    @property
+    def old_value(self):
+        """ Old value of the changed trait. """
+        if self._old_value_pending:
+            # Materialize the deferred snapshot on first read:
+            self._old_value = self._old_value_raw[:]
+            self._old_value_raw = None
+            self._old_value_pending = False
         return self._old_value
 
-    def _set_old_value(self, value):
+    @old_value.setter
+    def old_value(self, value):
         if isinstance(value, list):
-            value = value[:]
+            # Defer the O(n) copy until the value is actually read; most
+            # items are merged away or discarded without ever being
+            # inspected:
+            self._old_value_raw = value
+            self._old_value_pending = True
+            value = None
+        else:
+            self._old_value_pending = False
         self._old_value = value
 
-    def _get_new_value(self):
+    @property
+    def new_value(self):
+        """ New value of the changed trait. """
+        if self._new_value_pending:
+            self._new_value = self._new_value_raw[:]
+            self._new_value_raw = None
+            self._new_value_pending = False
         return self._new_value
 
-    def _set_new_value(self, value):
+    @new_value.setter
+    def new_value(self, value):
         if isinstance(value, list):
-            value = value[:]
+            self._new_value_raw = value
+            self._new_value_pending = True
+            value = None
+        else:
+            self._new_value_pending = False
         self._new_value = value
 
+    def _peek_old_value(self):
+        """ Returns the old value without forcing a deferred snapshot.
+
+        Used by read-only code paths (such as :meth:`merge_undo`) that only
+        compare values element-wise and never mutate them.
+        """
+        if self._old_value_pending:
+            return self._old_value_raw
+        return self._old_value
+
+    def _peek_new_value(self):
+        """ Returns the new value without forcing a deferred snapshot.
+        """
+        if self._new_value_pending:
+            return self._new_value_raw
+        return self._new_value
+
+    def _reset(self):
+        self.object = None
+        self.name = ""
+        self._old_value = self._new_value = None
+        self._old_value_raw = self._new_value_raw = None
+        self._old_value_pending = self._new_value_pending = False
+
     def undo(self):
         """ Undoes the change.
         """
@@ -129,58 +319,105 @@ class UndoItem(AbstractUndoItem):
             and (self.object is undo_item.object)
             and (self.name == undo_item.name)
         ):
-            v1 = self.new_value
-            v2 = undo_item.new_value
+            v1 = self._peek_new_value()
+            v2 = undo_item._peek_new_value()
             t1 = type(v1)
             if isinstance(v2, t1):
 
-                if isinstance(t1, str):
+                if isinstance(v1, str):
                     # Merge two undo items if they have new values which are
                     # strings which only differ by one character (corresponding
                     # to a single character insertion, deletion or replacement
-                    # operation in a text editor):
+                    # operation in a text editor).  The strings qualify when
+                    # their common prefix and suffix cover all but at most one
+                    # character of the shorter string:
                     n1 = len(v1)
                     n2 = len(v2)
                     if abs(n1 - n2) > 1:
                         return False
-                    n = min(n1, n2)
-                    i = 0
-                    while (i < n) and (v1[i] == v2[i]):
-                        i += 1
-                    if v1[i + (n2 <= n1) :] == v2[i + (n2 >= n1) :]:
+                    a, b = (v1, v2) if n1 >= n2 else (v2, v1)
+                    if a.startswith(b):
+                        # Fast path: a single character typed or deleted at
+                        # the end of the string (or both strings identical):
+                        self.new_value = v2
+                        return True
+                    # Otherwise the remainder of the shorter string, after
+                    # the common prefix and skipping the changed character
+                    # when the lengths are equal, must be a suffix of the
+                    # longer one.  Both checks run in C:
+                    p = _common_prefix_len(a, b)
+                    if a.endswith(b[p + (n1 == n2) :]):
                         self.new_value = v2
                         return True
 
-                elif isinstance(v1, collections.Sequence):
+                elif isinstance(v1, (list, tuple, bytes, bytearray)):
                     # Merge sequence types only if a single element has changed
                     # from the 'original' value, and the element type is a
-                    # simple Python type:
-                    v1 = self.old_value
-                    if isinstance(v1, collections.Sequence):
-                        # Note: wxColour says it's a sequence type, but it
-                        # doesn't support 'len', so we handle the exception
-                        # just in case other classes have similar behavior:
+                    # simple Python type.  A concrete type check is used here
+                    # since an ABC isinstance is several times slower and the
+                    # setters only ever see these types (strings are handled
+                    # above).  Reading the raw values avoids materializing the
+                    # deferred list snapshots, since the comparison below
+                    # never mutates them:
+                    v1 = self._peek_old_value()
+                    if isinstance(v1, (list, tuple, bytes, bytearray)):
                         try:
                             if len(v1) == len(v2):
-                                diffs = 0
-                                for i, item in enumerate(v1):
-                                    titem = type(item)
-                                    item2 = v2[i]
-                                    if (
-                                        (titem not in SimpleTypes)
-                                        or (not isinstance(item2, titem))
-                                        or (item != item2)
-                                    ):
-                                        diffs += 1
-                                        if diffs >= 2:
-                                            return False
-                                if diffs == 0:
+                                # For long homogeneous numeric sequences the
+                                # element-wise comparison can be done in
+                                # vector code:
+                                diffs = _vectorized_diff_count(v1, v2)
+                                if diffs is None:
+                                    # Precompute the membership test for the
+                                    # first element's type; in the common
+                                    # homogeneous case every later element
+                                    # resolves it with a type identity check
+                                    # instead of a set lookup:
+                                    t0 = type(v1[0]) if v1 else None
+                                    t0_simple = t0 in SimpleTypes
+                                    diffs = 0
+                                    for i, item in enumerate(v1):
+                                        titem = type(item)
+                                        item2 = v2[i]
+                                        if titem is t0:
+                                            simple = t0_simple
+                                        else:
+                                            simple = titem in SimpleTypes
+                                        if (
+                                            (not simple)
+                                            or (not isinstance(item2, titem))
+                                            or (item != item2)
+                                        ):
+                                            diffs += 1
+                                            if diffs >= 2:
+                                                return False
+                                if (diffs == 0) or (diffs >= 2):
                                     return False
                                 self.new_value = v2
                                 return True
                         except Exception:
                             pass
 
+                elif (np is not None) and isinstance(v1, np.ndarray):
+                    # Merge array values when at most a single element has
+                    # changed from the 'original' value; the element-wise
+                    # comparison runs in native code:
+                    v1 = self._peek_old_value()
+                    if (
+                        isinstance(v1, np.ndarray)
+                        and (v1.ndim == 1)
+                        and (v1.shape == v2.shape)
+                        and (v1.dtype == v2.dtype)
+                        and (v1.dtype.kind in "iufc")
+                    ):
+                        try:
+                            diffs = _count_diffs(v1, v2)
+                        except Exception:
+                            return False
+                        if diffs == 1:
+                            self.new_value = v2
+                            return True
+
                 elif t1 in NumericTypes:
                     # Always merge simple numeric trait changes:
                     self.new_value = v2
@@ -192,15 +429,19 @@ class UndoItem(AbstractUndoItem):
         """
         n = self.name
         cn = self.object.__class__.__name__
+        # Peeking at the values avoids materializing the deferred list
+        # snapshots just to print them:
         return "undo( %s.%s = %s )\nredo( %s.%s = %s )" % (
             cn,
             n,
-            self.old_value,
+            _item_repr.repr(self._peek_old_value()),
             cn,
             n,
-            self.new_value,
+            _item_repr.repr(self._peek_new_value()),
         )
 
+    _merge_fn = merge_undo
+
 
 class ListUndoItem(AbstractUndoItem):
     """ A change to a list, which can be undone.
@@ -210,6 +451,9 @@ class ListUndoItem(AbstractUndoItem):
     #  Trait definitions:
     # -------------------------------------------------------------------------
 
+    #: Free list of released instances (see AbstractUndoItem.acquire)
+    _free = collections.deque(maxlen=256)
+
     #: Object that the change occurred on
     object = Instance(HasTraits)
 
@@ -225,12 +469,42 @@ class ListUndoItem(AbstractUndoItem):
     #: Items removed from the list
     removed = List()
 
+    #: Number of items added, cached so that undo/redo use a plain int
+    #: instead of fetching the list trait and taking its length each call
+    _n_added = Int()
+
+    #: Number of items removed (see _n_added)
+    _n_removed = Int()
+
+    def _added_changed(self):
+        self._n_added = len(self.added)
+
+    def _added_items_changed(self):
+        self._n_added = len(self.added)
+
+    def _removed_changed(self):
+        self._n_removed = len(self.removed)
+
+    def _removed_items_changed(self):
+        self._n_removed = len(self.removed)
+
+    def _reset(self):
+        self.object = None
+        self.name = ""
+        self.index = 0
+        self.added = []
+        self.removed = []
+
     def undo(self):
         """ Undoes the change.
         """
         try:
-            list = getattr(self.object, self.name)
-            list[self.index : (self.index + len(self.added))] = self.removed
+            # The list must be fetched on every call: undoing or redoing
+            # other items in the history (e.g. an UndoItem that assigns a
+            # whole new list to the trait) replaces the trait's list object,
+            # so a cached reference can go stale:
+            items = getattr(self.object, self.name)
+            items[self.index : (self.index + self._n_added)] = self.removed
         except Exception:
             from traitsui.api import raise_to_debug
 
@@ -240,8 +514,8 @@ class ListUndoItem(AbstractUndoItem):
         """ Re-does the change.
         """
         try:
-            list = getattr(self.object, self.name)
-            list[self.index : (self.index + len(self.removed))] = self.added
+            items = getattr(self.object, self.name)
+            items[self.index : (self.index + self._n_removed)] = self.added
         except Exception:
             from traitsui.api import raise_to_debug
 
@@ -261,18 +535,15 @@ class ListUndoItem(AbstractUndoItem):
         ):
             added = undo_item.added
             removed = undo_item.removed
-            if (len(self.added) == len(added)) and (
-                len(self.removed) == len(removed)
+            # The element-wise identity checks iterate in C under all(),
+            # and short-circuit on the first mismatch:
+            if (
+                (self._n_added == len(added))
+                and (self._n_removed == len(removed))
+                and all(x is y for x, y in zip(self.added, added))
+                and all(x is y for x, y in zip(self.removed, removed))
             ):
-                for i, item in enumerate(self.added):
-                    if item is not added[i]:
-                        break
-                else:
-                    for i, item in enumerate(self.removed):
-                        if item is not removed[i]:
-                            break
-                    else:
-                        return True
+                return True
         return False
 
     def __repr__(self):
@@ -282,31 +553,104 @@ class ListUndoItem(AbstractUndoItem):
             self.object.__class__.__name__,
             self.name,
             self.index,
-            self.index + len(self.removed),
-            self.added,
+            self.index + self._n_removed,
+            _item_repr.repr(self.added),
         )
 
+    _merge_fn = merge_undo
+
 
 class UndoHistory(HasStrictTraits):
     """ Manages a list of undoable changes.
+
+    The undo items are kept in a single flat list with a parallel list of
+    group boundary offsets, rather than as a list of per-group lists.  This
+    avoids allocating an inner list object for every change that is added,
+    which matters for interactive sessions where each keystroke can create
+    a history entry.
     """
 
     # -------------------------------------------------------------------------
     #  Trait definitions:
     # -------------------------------------------------------------------------
 
-    #: List of accumulated undo changes
-    history = List()
+    #: List of accumulated undo changes, as a list of lists of undo items
+    history = Property()
     #: The current position in the list
     now = Int()
     #: Fired when state changes to undoable
     undoable = Event(False)
     #: Fired when state changes to redoable
     redoable = Event(False)
-    #: Can an action be undone?
-    can_undo = Property()
-    #: Can an action be redone?
-    can_redo = Property()
+
+    #: Maximum number of undo groups retained; when the bound is exceeded
+    #: the oldest groups are discarded.  A value of 0 or less means the
+    #: history is unbounded.
+    max_depth = Int(1000)
+
+    #: Flat list of all undo items in the history
+    _items = List(Instance(AbstractUndoItem))
+    #: Group boundary offsets into _items; group i holds the items in
+    #: _items[_group_starts[i]:_group_starts[i + 1]]
+    _group_starts = List(Int, [0])
+    #: Cached undoable/redoable state, maintained at the mutation sites so
+    #: the frequently polled can_undo/can_redo queries are plain attribute
+    #: reads instead of Property dispatches
+    _can_undo = Bool(False)
+    _can_redo = Bool(False)
+
+    #: Whether a batch() context is currently active
+    _in_batch = Bool(False)
+    #: Deferred state while batching: the pending 'now' value and the
+    #: pending undoable/redoable notifications (None when nothing pending)
+    _pending_now = Any()
+    _pending_undoable = Any()
+    _pending_redoable = Any()
+
+    @property
+    def can_undo(self):
+        """ Are there any undoable operations? """
+        return self._can_undo
+
+    @property
+    def can_redo(self):
+        """ Are there any redoable operations? """
+        return self._can_redo
+
+    @contextmanager
+    def batch(self):
+        """ Context manager that coalesces the updates for a burst of
+        changes (e.g. a paste operation) into a single 'now' change and at
+        most one undoable/redoable notification each.
+        """
+        if self._in_batch:
+            # Nested batches are flattened into the outermost one:
+            yield
+            return
+
+        self._in_batch = True
+        try:
+            yield
+        finally:
+            self._in_batch = False
+            pending = self._pending_now
+            if pending is not None:
+                self._pending_now = None
+                self.now = pending
+            pending = self._pending_undoable
+            if pending is not None:
+                self._pending_undoable = None
+                self.undoable = pending
+            pending = self._pending_redoable
+            if pending is not None:
+                self._pending_redoable = None
+                self.redoable = pending
+
+    def _effective_now(self):
+        """ The current position, including any deferred batched update.
+        """
+        pending = self._pending_now
+        return self.now if pending is None else pending
 
     def add(self, undo_item, extend=False):
         """ Adds an UndoItem to the history.
@@ -316,20 +660,78 @@ class UndoHistory(HasStrictTraits):
             return
 
         # Try to merge the new undo item with the previous item if allowed:
-        now = self.now
+        now = self._effective_now()
+        items = self._items
+        starts = self._group_starts
         if now > 0:
-            previous = self.history[now - 1]
-            if (len(previous) == 1) and previous[0].merge_undo(undo_item):
-                self.history[now:] = []
+            lo, hi = starts[now - 1], starts[now]
+            previous = items[lo]
+            cls = undo_item.__class__
+            # merge_undo can only succeed for items of the same class, so
+            # skip the call outright when the classes differ (e.g. a scalar
+            # change following a list change).  When they match, dispatch
+            # through the class's merge function pointer, avoiding the
+            # instance method lookup:
+            if (
+                ((hi - lo) == 1)
+                and (previous.__class__ is cls)
+                and cls._merge_fn(previous, undo_item)
+            ):
+                # The merged-in item and any redoable items beyond the
+                # merged group are no longer referenced, so recycle them:
+                undo_item.release()
+                if hi < len(items):
+                    for item in items[hi:]:
+                        item.release()
+                    del items[hi:]
+                    del starts[now + 1 :]
+                self._can_redo = False
                 return
 
-        old_len = len(self.history)
-        self.history[now:] = [[undo_item]]
-        self.now += 1
-        if self.now == 1:
-            self.undoable = True
-        if self.now <= old_len:
-            self.redoable = False
+        old_len = len(starts) - 1
+        # Discard any redoable groups and append the new single-item group.
+        # All mutations are done through the local bindings, with 'now'
+        # written back once and the events fired last, so that listeners
+        # never observe a partially updated history.  In the common case of
+        # adding at the end of the history, no truncation (and hence no
+        # temporary slice) is needed at all:
+        hi = starts[now]
+        if hi < len(items):
+            for item in items[hi:]:
+                item.release()
+            del items[hi:]
+            del starts[now + 1 :]
+        items.append(undo_item)
+        starts.append(len(items))
+        now += 1
+        # Enforce the depth bound by evicting the oldest groups and
+        # rebasing the group offsets:
+        max_depth = self.max_depth
+        if (max_depth > 0) and ((len(starts) - 1) > max_depth):
+            n_evict = (len(starts) - 1) - max_depth
+            cut = starts[n_evict]
+            for item in items[:cut]:
+                item.release()
+            del items[:cut]
+            del starts[:n_evict]
+            for i in range(len(starts)):
+                starts[i] -= cut
+            now -= n_evict
+        self._can_undo = True
+        self._can_redo = False
+        if self._in_batch:
+            # Defer the 'now' change and the notifications to batch exit:
+            self._pending_now = now
+            if now == 1:
+                self._pending_undoable = True
+            if now <= old_len:
+                self._pending_redoable = False
+        else:
+            self.now = now
+            if now == 1:
+                self.undoable = True
+            if now <= old_len:
+                self.redoable = False
 
     def extend(self, undo_item):
         """ Extends the undo history.
@@ -337,67 +739,116 @@ class UndoHistory(HasStrictTraits):
         If possible the method merges the new UndoItem with the last item in
         the history; otherwise, it appends the new item.
         """
-        if self.now > 0:
-            undo_list = self.history[self.now - 1]
-            if not undo_list[-1].merge_undo(undo_item):
-                undo_list.append(undo_item)
+        now = self._effective_now()
+        if now > 0:
+            items = self._items
+            starts = self._group_starts
+            hi = starts[now]
+            if items[hi - 1].merge_undo(undo_item):
+                undo_item.release()
+            else:
+                items.insert(hi, undo_item)
+                for i in range(now, len(starts)):
+                    starts[i] += 1
 
     def undo(self):
         """ Undoes an operation.
         """
         if self.can_undo:
-            self.now -= 1
-            items = self.history[self.now]
-            for i in range(len(items) - 1, -1, -1):
-                items[i].undo()
-            if self.now == 0:
-                self.undoable = False
-            if self.now == (len(self.history) - 1):
-                self.redoable = True
+            starts = self._group_starts
+            now = self._effective_now() - 1
+            self._undo_range(starts[now], starts[now + 1])
+            self._can_undo = now > 0
+            self._can_redo = True
+            if self._in_batch:
+                self._pending_now = now
+                if now == 0:
+                    self._pending_undoable = False
+                if now == (len(starts) - 2):
+                    self._pending_redoable = True
+            else:
+                self.now = now
+                if now == 0:
+                    self.undoable = False
+                if now == (len(starts) - 2):
+                    self.redoable = True
 
     def redo(self):
         """ Redoes an operation.
         """
         if self.can_redo:
-            self.now += 1
-            for item in self.history[self.now - 1]:
-                item.redo()
-            if self.now == 1:
-                self.undoable = True
-            if self.now == len(self.history):
-                self.redoable = False
+            starts = self._group_starts
+            now = self._effective_now() + 1
+            self._redo_range(starts[now - 1], starts[now])
+            self._can_undo = True
+            self._can_redo = now < (len(starts) - 1)
+            if self._in_batch:
+                self._pending_now = now
+                if now == 1:
+                    self._pending_undoable = True
+                if now == (len(starts) - 1):
+                    self._pending_redoable = False
+            else:
+                self.now = now
+                if now == 1:
+                    self.undoable = True
+                if now == (len(starts) - 1):
+                    self.redoable = False
 
     def revert(self):
         """ Reverts all changes made so far and clears the history.
         """
-        history = self.history[: self.now]
+        items = self._items[: self._group_starts[self._effective_now()]]
         self.clear()
-        for i in range(len(history) - 1, -1, -1):
-            items = history[i]
-            for j in range(len(items) - 1, -1, -1):
-                items[j].undo()
+        for item in reversed(items):
+            item.undo()
 
     def clear(self):
         """ Clears the undo history.
         """
-        old_len = len(self.history)
-        old_now = self.now
-        self.now = 0
-        del self.history[:]
-        if old_now > 0:
-            self.undoable = False
-        if old_now < old_len:
-            self.redoable = False
-
-    def _get_can_undo(self):
-        """ Are there any undoable operations?
+        old_len = len(self._group_starts) - 1
+        old_now = self._effective_now()
+        # Any deferred batched state refers to the history being discarded:
+        self._pending_undoable = None
+        self._pending_redoable = None
+        del self._items[:]
+        del self._group_starts[1:]
+        self._can_undo = self._can_redo = False
+        if self._in_batch:
+            self._pending_now = 0
+            if old_now > 0:
+                self._pending_undoable = False
+            if old_now < old_len:
+                self._pending_redoable = False
+        else:
+            self._pending_now = None
+            self.now = 0
+            if old_now > 0:
+                self.undoable = False
+            if old_now < old_len:
+                self.redoable = False
+
+    def _undo_range(self, lo, hi):
+        """ Undoes the items in _items[lo:hi], most recent change first.
+        """
+        for item in reversed(self._items[lo:hi]):
+            item.undo()
+
+    def _redo_range(self, lo, hi):
+        """ Redoes the items in _items[lo:hi], oldest change first.
         """
-        return self.now > 0
+        for item in self._items[lo:hi]:
+            item.redo()
 
-    def _get_can_redo(self):
-        """ Are there any redoable operations?
+    def _get_history(self):
+        """ Reconstructs the grouped form of the history.
         """
-        return self.now < len(self.history)
+        items = self._items
+        starts = self._group_starts
+        return [
+            items[starts[i] : starts[i + 1]] for i in range(len(starts) - 1)
+        ]
+
 
 
 class UndoHistoryUndoItem(AbstractUndoItem):
@@ -415,15 +866,10 @@ class UndoHistoryUndoItem(AbstractUndoItem):
         """ Undoes the change.
         """
         history = self.history
-        for i in range(history.now - 1, -1, -1):
-            items = history.history[i]
-            for j in range(len(items) - 1, -1, -1):
-                items[j].undo()
+        history._undo_range(0, history._group_starts[history.now])
 
     def redo(self):
         """ Re-does the change.
         """
         history = self.history
-        for i in range(0, history.now):
-            for item in history.history[i]:
-                item.redo()
+        history._redo_range(0, history._group_starts[history.now])